@@ -19,6 +19,14 @@ import OptimizeCode from "./components/OptimizeCode"
 import GenerateTests from "./components/GenerateTests"
 import FilenameDisplay from "./components/FilenameDisplay"
 
+// Identifies this editor tab so the backend can cancel requests superseded by newer ones
+const EDITOR_SESSION_ID = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`
+axios.defaults.headers.common["X-Editor-Session"] = EDITOR_SESSION_ID
+
+// 409 means a newer request from this tab superseded this one and 499 that it was abandoned;
+// their responses must not overwrite editor state or raise toasts
+const isAbandonedRequest = (error) => [409, 499].includes(error.response?.status)
+
 // Language templates with proper naming conventions
 const LANGUAGE_TEMPLATES = {
   python: `# Write your Python code here
@@ -228,6 +236,7 @@ function App() {
         toast.error("Code execution failed")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Code execution error:", error)
       setOutput(`Error: ${error.response?.data?.detail || error.message}`)
       toast.error("Code execution failed")
@@ -269,6 +278,7 @@ function App() {
         throw new Error("No code was generated")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Code generation error:", error)
       toast.error("Code generation failed: " + (error.response?.data?.detail || error.message))
       setExplanation(`Error: ${error.response?.data?.detail || error.message}`)
@@ -297,6 +307,7 @@ function App() {
         throw new Error("No explanation was generated")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Code explanation error:", error)
       toast.error("Code explanation failed: " + (error.response?.data?.detail || error.message))
       setExplanation(`Error: ${error.response?.data?.detail || error.message}`)
@@ -325,6 +336,7 @@ function App() {
         setSyntaxErrors([])
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Syntax check failed:", error)
       // On error, show a generic syntax check failure message
       setSyntaxErrors([
@@ -361,6 +373,7 @@ function App() {
         throw new Error("No translation was generated")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Code translation error:", error)
       toast.error("Code translation failed: " + (error.response?.data?.detail || error.message))
       setExplanation(`Error: ${error.response?.data?.detail || error.message}`)
@@ -391,6 +404,7 @@ function App() {
         throw new Error("No optimization was generated")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Code optimization error:", error)
       toast.error("Code optimization failed: " + (error.response?.data?.detail || error.message))
       setExplanation(`Error: ${error.response?.data?.detail || error.message}`)
@@ -421,6 +435,7 @@ function App() {
         throw new Error("No test cases were generated")
       }
     } catch (error) {
+      if (isAbandonedRequest(error)) return
       console.error("Test generation error:", error)
       toast.error("Test generation failed: " + (error.response?.data?.detail || error.message))
       setExplanation(`Error: ${error.response?.data?.detail || error.message}`)